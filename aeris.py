@@ -6,7 +6,6 @@ Copyright (C) 2019,2020,2021 Robert Paauwe
 
 import udi_interface
 import sys
-import time
 from nodes import aeris
 from nodes import aeris_daily
 
@@ -5,14 +5,7 @@ Copyright (C) 2019,2020,2021 Robert Paauwe
 """
 
 import udi_interface
-import sys
 import time
-import datetime
-import requests
-import socket
-import math
-import re
-import json
 #import node_funcs
 from nodes import aeris_daily
 from nodes import query
@@ -20,6 +13,9 @@ from nodes import query
 LOGGER = udi_interface.LOGGER
 Custom = udi_interface.Custom
 
+# Maximum number of forecast days (and forecast nodes) supported
+MAX_FORECAST_DAYS = 12
+
 class Controller(udi_interface.Node):
     id = 'weather'
     def __init__(self, polyglot, primary, address, name):
@@ -30,6 +26,7 @@ class Controller(udi_interface.Node):
         self.address = address
         self.primary = primary
         self.configured = False
+        self.forecast_days = 0
         self.node_added_count = 0
 
         self.Notices = Custom(polyglot, 'notices')
@@ -41,56 +38,60 @@ class Controller(udi_interface.Node):
         self.poly.subscribe(self.poly.CUSTOMPARAMS, self.parameterHandler)
         self.poly.subscribe(self.poly.START, self.start, address)
         self.poly.subscribe(self.poly.POLL, self.poll)
+        self.poly.subscribe(self.poly.STOP, self.stop)
         self.poly.subscribe(self.poly.ADDNODEDONE, self.nodeHandler)
 
         self.poly.ready()
         self.poly.addNode(self)
 
+    # Required parameters: (name, notice key, notice, validation)
+    required_params = [
+            ('ClientID', 'id', 'AERIS client ID must be configured.',
+                lambda v: len(v) == 21),
+            ('ClientSecret', 'secret', 'AERIS client secret key must be configured.',
+                lambda v: len(v) == 40),
+            ('Location', 'loc', 'AERIS location must be configured.',
+                lambda v: 'PWS' in v or len(v) > 2),
+            ]
+
+    # Parameters passed on to the query object: (name, property)
+    query_params = [
+            ('Units', 'units'),
+            ('Location', 'location'),
+            ('ClientID', 'client_id'),
+            ('ClientSecret', 'client_secret'),
+            ('Plant Type', 'plant_type'),
+            ('Elevation', 'elevation'),
+            ]
+
     # Process changes to customParameters
     def parameterHandler(self, params):
-        validCli = False
-        validSec = False
-        validLoc = False
         self.Parameters.load(params)
         #self.params.update(self.Parameters)
 
-        if self.Parameters['ClientID'] is not None:
-            if len(self.Parameters['ClientID']) == 21:
-                validCli = True
-            else:
-                LOGGER.debug('Client ID {} invalid.'.format(self.Parameters['ClientID']))
-        else:
-            LOGGER.error('Client ID is missing.')
-
-        if self.Parameters['ClientSecret'] is not None:
-            if len(self.Parameters['ClientSecret']) == 40:
-                validSec = True
-            else:
-                LOGGER.debug('Client Secret {} invalid.'.format(self.Parameters['ClientSecret']))
-        else:
-            LOGGER.error('Client Secret is missing.')
-
-        if self.Parameters['Location'] is not None:
-            if 'PWS' in self.Parameters['Location']:
-                validLoc = True
-            elif len(self.Parameters['Location']) > 2:
-                validLoc = True
-            else:
-                LOGGER.debug('Location {} invalid.'.format(self.Parameters['Location']))
-        else:
-            LOGGER.error('Client Secret is missing.')
-
+        invalid = []
+        for name, key, notice, valid in self.required_params:
+            value = self.Parameters[name]
+            if value is None:
+                LOGGER.error('{} is missing.'.format(name))
+                invalid.append((name, key, notice))
+            elif not valid(value):
+                LOGGER.debug('{} {} invalid.'.format(name, value))
+                invalid.append((name, key, notice))
+
+        try:
+            days = int(self.Parameters['Forecast Days'] or 0)
+        except ValueError:
+            LOGGER.warning('Forecast Days {} invalid, using 0.'.format(self.Parameters['Forecast Days']))
+            days = 0
+        self.forecast_days = min(max(days, 0), MAX_FORECAST_DAYS)
 
         self.Notices.clear()
 
-        if validCli and validSec and validLoc:
-            self.q.units = self.Parameters['Units']
-            self.q.location = self.Parameters['Location']
-            self.q.client_id = self.Parameters['ClientID']
-            self.q.client_secret = self.Parameters['ClientSecret']
-            self.q.plant_type = self.Parameters['Plant Type']
-            self.q.days = self.Parameters['Forecast Days']
-            self.q.elevation = self.Parameters['Elevation']
+        if not invalid:
+            for name, prop in self.query_params:
+                setattr(self.q, prop, self.Parameters[name])
+            self.q.days = self.forecast_days
             self.q.configured = True
             self.configured = True
 
@@ -100,15 +101,9 @@ class Controller(udi_interface.Node):
                 self.discover()
                 self.q.query_forecasts(self.Parameters['Units'], True)
         else:
-            if not validCli:
-                LOGGER.warning('Client ID must be set')
-                self.Notices['id'] = 'AERIS client ID must be configured.'
-            if not validSec:
-                LOGGER.warning('Client secret must be set')
-                self.Notices['secret'] = 'AERIS client secret key must be configured.'
-            if not validLoc:
-                LOGGER.warning('Location must be set')
-                self.Notices['loc'] = 'AERIS location must be configured.'
+            for name, key, notice in invalid:
+                LOGGER.warning('{} must be set'.format(name))
+                self.Notices[key] = notice
 
     def configHandler(self, config):
         # at this time the interface should have all the nodes
@@ -153,17 +148,30 @@ class Controller(udi_interface.Node):
         # Create any additional nodes here
         LOGGER.info("In Discovery...")
 
+        num_days = self.forecast_days
+
+        # Only touch the forecast nodes that don't match the number
+        # of days configured.
+        wanted = set(range(num_days))
+        existing = set(day for day in range(MAX_FORECAST_DAYS) if self.poly.getNode('forecast_' + str(day)))
+        if existing == wanted:
+            LOGGER.info('Forecast nodes already match {} days'.format(num_days))
+        else:
+            self.update_forecast_nodes(num_days, existing - wanted)
+
+        # The query updates the forecast nodes in this order
+        self.q.forecast_nodes = [self.poly.getNode('forecast_' + str(day)) for day in range(num_days)]
+
+    def update_forecast_nodes(self, num_days, extra_days):
         node_count = 1
-        num_days = int(self.Parameters['Forecast Days'])
-        if num_days < 7:
-            # delete any extra days
-            for day in range(num_days, 7):
-                address = 'forecast_' + str(day)
-                try:
-                    if self.poly.getNode(address):
-                        self.poly.delNode(address)
-                except:
-                    LOGGER.debug('Failed to delete node ' + address)
+
+        # delete any extra days
+        for day in sorted(extra_days):
+            address = 'forecast_' + str(day)
+            try:
+                self.poly.delNode(address)
+            except:
+                LOGGER.debug('Failed to delete node ' + address)
 
         for day in range(0,num_days):
             address = 'forecast_' + str(day)
@@ -198,6 +206,7 @@ class Controller(udi_interface.Node):
 
     def stop(self):
         LOGGER.info('Stopping node server')
+        self.q.close()
 
     def remove_notices_all(self, command):
         self.Notices.clear()
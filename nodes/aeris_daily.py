@@ -1,7 +1,6 @@
 # Node definition for a daily forecast node
 
 import udi_interface
-import json
 import time
 import datetime
 from nodes import et3
@@ -43,6 +42,20 @@ class DailyNode(udi_interface.Node):
         self.min_humidity = 0
         self.max_humidity = 0
 
+    # Update the node from one daily forecast period.  wmap is the
+    # query.WeatherData mapping for the units the forecast was made in.
+    def update_forecast(self, forecast, wmap, latitude, force):
+        epoch = int(forecast['timestamp'])
+        dow = time.strftime("%w", time.gmtime(epoch))
+        self.setDriver('GV19', dow, True, force, wmap.uom('GV19'))
+
+        # ETo is calculated and the day of week is set above
+        query.update_drivers(self, wmap, forecast, 'ftag', ('ETO', 'GV19'), force)
+
+        self.max_humidity = float(forecast['maxHumidity'])
+        self.min_humidity = float(forecast['minHumidity'])
+        self.set_ETo(epoch, latitude, force)
+
     def mm2inch(self, mm):
         return round(mm/25.4, 2)
 
@@ -96,6 +109,6 @@ class DailyNode(udi_interface.Node):
         if self.units == 'imperial' or self.units == 'uk':
             et0 = self.mm2inch(et0)
         
-        wmap = query.WeatherData(self.units)
+        wmap = query.weather_data(self.units)
         self.setDriver('ETO', et0, True, force, wmap.uom('ETO'))
         LOGGER.info('ETo = {}'.format(et0))
@@ -9,11 +9,53 @@ export:
 import udi_interface
 import requests
 import time
-import datetime
+import hashlib
+from urllib.parse import quote, urlencode
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.exceptions import TimeoutError as Urllib3Timeout
+from concurrent.futures import ThreadPoolExecutor
 from nodes import weather_codes as wx
 
+# Use the fastest JSON parser available. All of these accept bytes.
+try:
+    import orjson as json
+except ImportError:
+    try:
+        import ujson as json
+    except ImportError:
+        import json
+
 LOGGER = udi_interface.LOGGER
 
+# Weather code lookups used by the WeatherData parsers
+split_coded = wx.split_coded
+coverage_codes = wx.coverage_codes
+intensity_codes = wx.intensity_codes
+weather_codes = wx.weather_codes
+
+# Controller drivers that are not read from the observation data.
+# ST is the node server status and PRECIP comes from the summary query.
+NOT_OBSERVED = ('ST', 'PRECIP')
+
+# Configuration properties that are part of the query URLs
+URL_PARAMS = ('api', 'location', 'days')
+
+# Returned by _get_weather_data when the server reports no new data
+# (HTTP 304) since the last response for that endpoint.
+NOT_MODIFIED = object()
+
+# How long, in seconds, a response is reused before querying again.
+# Forecasts only change about once an hour.
+CACHE_TTL = {
+        'observations': 50,
+        'observations/summary': 300,
+        'forecasts': 1800,
+        }
+
+# (connect, read) timeouts in seconds for the Aeris requests
+TIMEOUT = (3.05, 10)
+
 """
 The WeatherData class holds the mapping of drivers to UOM, query tags,
 and possibly parsing functions.
@@ -89,9 +131,10 @@ class WeatherData:
             self.__dict__['GV8']     = {'uom': 48,  'tag': 'windSpeedMinMPH', 'ftag': 'windSpeedMinMPH', 'parse': None} # min wind   
             self.__dict__['GV15']    = {'uom': 105, 'tag': 'snowDepthIN',     'ftag': 'snowIN',          'parse': None} # snow depth
 
-        self.__dict__['GV11']['parse'] = 'self._parse_coverage_codes'
-        self.__dict__['GV12']['parse'] = 'self._parse_intensity_codes'
-        self.__dict__['GV13']['parse'] = 'self._parse_weather_codes'
+        self.__dict__['GV11']['parse'] = self._parse_coverage_codes
+        self.__dict__['GV12']['parse'] = self._parse_intensity_codes
+        self.__dict__['GV13']['parse'] = self._parse_weather_codes
+        self.__dict__['_fields'] = {}
 
     def __setattr__(self, name, value):
         if name in self.__dict__:
@@ -113,97 +156,33 @@ class WeatherData:
     def uom(self, name):
         return self.__dict__[name]['uom']
 
+    # Return a tuple of (driver, tag, uom, parse) for the node's drivers,
+    # using either the observation ('tag') or forecast ('ftag') tags and
+    # leaving out the drivers in skip.  Built once per type of node.
+    def fields(self, node, key, skip=()):
+        cache_key = (node.id, key, tuple(skip))
+        if cache_key not in self._fields:
+            self._fields[cache_key] = tuple(
+                    (drv['driver'], self.__dict__[drv['driver']][key],
+                     self.__dict__[drv['driver']]['uom'],
+                     self.__dict__[drv['driver']]['parse'])
+                    for drv in node.drivers if drv['driver'] not in skip)
+        return self._fields[cache_key]
+
     def _parse_weather_codes(self, code):
-        # looks like ::H,::SC
-        # first split on ','
-
-        code = code.split(',')[0]
-        code = code.split(':')[2]
-        code_map = {
-            'A': 0,   # hail
-            'BD': 1,  # blowing dust
-            'BN': 2,  # blowing sand
-            'BR': 3,  # mist
-            'BS': 4,  # blowing snow
-            'BY': 5,  # blowing spray
-            'F': 6,   # fog
-            'FR': 7,  # frost
-            'H': 8,   # haze
-            'IC': 9,  # ice crystals
-            'IF': 10, # ice fog
-            'IP': 11, # ice pellets / Sleet
-            'K': 12,  # smoke
-            'L': 13,  # drizzle
-            'R': 14,  # rain
-            'RW': 15, # rain showers
-            'RS': 16, # rain/snow mix
-            'SI': 17, # snow/sleet mix
-            'WM': 18, # wintry mix (sno, sleet, rain)
-            'S': 19,  # snow
-            'SW': 20, # snow showers
-            'T': 21,  # Thunderstorms
-            'UP': 22, # unknown precipitation
-            'VA': 23, # volcanic ash
-            'WP': 24, # waterspouts
-            'ZF': 25, # freezing fog
-            'ZL': 26, # freezing drizzle
-            'ZR': 27, # freezing rain
-            'ZY': 28, # freezing spray
-            'CL': 29, # Clear
-            'FW': 30, # Fair/Mostly sunny
-            'SC': 31, # Partly cloudy
-            'BK': 32, # Mostly cloudy
-            'OV': 33, # Cloudy/Overcast
-            }
-
-        if code in code_map:
-            return code_map[code]
-
-        return 22
+        return weather_codes(split_coded(code)[2])
 
     def _parse_intensity_codes(self, code):
-        code = code.split(',')[0]
-        code = code.split(':')[1]
-        code_map = {
-            'VL': 1,  # very light
-            'L': 2,   # light
-            'H': 3,   # heavy
-            'VH': 4,  # very heavy
-            }
-        if code in code_map:
-            return code_map[code]
-        return 0  # moderate
+        return intensity_codes(split_coded(code)[1])
 
     def _parse_coverage_codes(self, code):
-        code = code.split(',')[0]
-        code = code.split(':')[0]
-        code_map = {
-            'AR': 0,  # areas of
-            'BR': 1,  # brief
-            'C':  2,  # chance of
-            'D':  3,  # definite
-            'FQ': 4,  # frequent
-            'IN': 5,  # intermittent
-            'IS': 6,  # isolated
-            'L':  7,  # likely
-            'NM': 8,  # numerous
-            'O':  9,  # occasional
-            'PA': 10,  # patchy
-            'PD': 11,  # periods of
-            'S':  12,  # slight chance
-            'SC': 13,  # scattered
-            'VC': 14,  # in the vicinity/nearby
-            'WD': 15,  # widespread
-            }
-        if code in code_map:
-            return code_map[code]
-        return 16
+        return coverage_codes(split_coded(code)[0])
 
     def parse(self, name, data):
         tag = self.__dict__[name]['tag']
         if tag in data:
             if self.__dict__[name]['parse'] is not None:
-                return eval(self.__dict__[name]['parse'])(data[tag])
+                return self.__dict__[name]['parse'](data[tag])
             else:
                 return data[tag]
         raise self.ConstError("{}: {} not found in data.".format(name, tag))
@@ -212,12 +191,59 @@ class WeatherData:
         tag = self.__dict__[name]['ftag']
         if tag in data:
             if self.__dict__[name]['parse'] is not None:
-                return eval(self.__dict__[name]['parse'])(data[tag])
+                return self.__dict__[name]['parse'](data[tag])
             else:
                 return data[tag]
         raise self.ConstError("{}: {} not found in data.".format(name, tag))
 
 
+# Convert a value from the Aeris data to a number. Missing values (null)
+# are reported as 0, anything that isn't numeric returns None.
+def to_number(value):
+    if value is None or value == 'None':
+        return 0.0
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+# Set the node's drivers from the Aeris data. key selects the
+# observation ('tag') or forecast ('ftag') field names and the drivers
+# in skip are left alone. Fields missing from the data are skipped.
+def update_drivers(node, wmap, data, key, skip, force):
+    prec = 1  ## TODO: this may need to go in wmap too or can we pull this from editor?
+    for driver, tag, uom, parse in wmap.fields(node, key, skip):
+        if tag not in data:
+            LOGGER.debug('%s not in data', driver)
+            continue
+
+        try:
+            raw = data[tag]
+            v = to_number(raw if parse is None else parse(raw))
+            if v is None:
+                LOGGER.debug('Bad data for %s: %r', driver, raw)
+                continue
+            if driver == 'GV15' and wmap.isMetric:
+                v = v * 10 # snow depth is in cm, convert to mm
+            node.setDriver(driver, round(v, prec), True, force, uom)
+            LOGGER.debug('setDriver (%s, %f)', driver, v)
+        except (AttributeError, IndexError, TypeError, ValueError) as e:
+            LOGGER.warning('Error updating {}: {}'.format(driver, e))
+
+# WeatherData never changes once built, so share one instance per
+# units setting instead of rebuilding the mapping on every query.
+_weather_data = {}
+
+def weather_data(units):
+    if units not in _weather_data:
+        _weather_data[units] = WeatherData(units)
+    return _weather_data[units]
+
+# True if a requests exception was caused by a urllib3 timeout. Once
+# the retries are used up requests raises these as ConnectionError.
+def is_timeout(e):
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, Urllib3Timeout)
 
 
 class queries(object):
@@ -230,50 +256,187 @@ class queries(object):
         self.__dict__['location'] = ''
         self.__dict__['client_id'] = ''
         self.__dict__['client_secret'] = ''
+        self.__dict__['auth'] = {}
         self.__dict__['plant_type'] = 0
         self.__dict__['elevation'] = 0
         self.__dict__['configured'] = False
-        self.api = 'http://api.aerisapi.com/'
+        self.api = 'https://api.aerisapi.com/'
+        self.urls = {}
+        self.validators = {}
+        self.digests = {}
+        self.cache = {}
+        self.forecast_nodes = []
         self.latitude = 0
-        self.tag = {}
+
+        # Keep a single session so the connection to the Aeris server
+        # is reused between polls instead of being set up every time.
+        self.http = requests.Session()
+        # Only retry failed connects. Retrying a read that timed out
+        # would let a stalled server hold up the poll for several times
+        # the read timeout.
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4,
+                max_retries=Retry(total=2, read=0, backoff_factor=0.3))
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.pool = ThreadPoolExecutor(max_workers=2)
 
 
 
     def __setattr__(self, key, value):
         self.__dict__[key] = value
-
-    # Make and call the actual query URL
-    def _get_weather_data(self, extra, lat=None, long=None):
-        request = self.api + extra + '/'
-
-        request += self.location
-        request += '?client_id=' + self.client_id
-        request += '&client_secret=' + self.client_secret
+        if key in URL_PARAMS:
+            self.__dict__['urls'] = {}
+            self.__dict__['validators'] = {}
+            self.__dict__['digests'] = {}
+            self.__dict__['cache'] = {}
+        if key in ('client_id', 'client_secret'):
+            self.__dict__['auth'] = {
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    }
+
+    # Build the query URL for an endpoint.  The URLs only depend on
+    # the configuration so they are cached until that changes. The
+    # credentials are passed separately as query parameters.
+    def _build_url(self, extra):
+        request = self.api + extra + '/' + quote(self.location, safe=',')
 
         if extra == 'forecasts':
-            request += '&filter=mdnt2mdnt'
+            request += '?' + urlencode({'filter': 'mdnt2mdnt', 'limit': self.days})
             request += '&precise'
-            request += '&limit=' + str(self.days)
 
         if extra == 'observations/summary':
-            request += '&fields=periods.summary.precip'
+            request += '?' + urlencode({'fields': 'periods.summary.precip'})
 
         #FIXME: add unit support if available
         #request += '&units=' + self.units
 
-        LOGGER.debug('request = %s' % request)
+        return request
+
+    # Called when the node server stops. Clearing configured makes any
+    # poll that arrives afterwards skip the queries.
+    def close(self):
+        self.configured = False
+        self.pool.shutdown(wait=False)
+        self.http.close()
+
+    # Drop any saved state for the endpoints so the next query
+    # fetches fresh data.
+    def _forget(self, *extras):
+        for extra in extras:
+            self.cache.pop(extra, None)
+            self.validators.pop(extra, None)
+            self.digests.pop(extra, None)
+
+    # Request headers that ask the server to only send the data if it
+    # changed since the given response.
+    def _validators(self, response):
+        headers = {}
+        if 'ETag' in response.headers:
+            headers['If-None-Match'] = response.headers['ETag']
+        if 'Last-Modified' in response.headers:
+            headers['If-Modified-Since'] = response.headers['Last-Modified']
+        return headers
+
+    # Make and call the actual query URL
+    def _get_weather_data(self, extra, lat=None, long=None):
+        request = self.urls.get(extra)
+        if request is None:
+            request = self._build_url(extra)
+            self.urls[extra] = request
+
+        # Entries are tagged with the URL they were fetched from. A
+        # request that was in flight when the configuration changed
+        # can store data for the old location after the invalidation,
+        # so anything not matching the current URL is ignored.
+        cached = self.cache.get(extra)
+        if cached is not None and cached[0] != request:
+            cached = None
+        if cached is not None and time.monotonic() < cached[1]:
+            LOGGER.debug('Using cached %s data', extra)
+            return cached[2]
+
+        LOGGER.debug('request = %s', request)
+
+        validators = self.validators.get(extra)
+        headers = validators[1] if validators and validators[0] == request else {}
 
         try:
-            c = requests.get(request)
-            jdata = c.json()
-            c.close()
+            # Read the body straight from the connection rather than
+            # having requests buffer it in chunks first.
+            c = self.http.get(request, params=self.auth, headers=headers, stream=True, timeout=TIMEOUT)
+            try:
+                body = c.raw.read(decode_content=True)
+            finally:
+                c.close()
+
+            # A server that doesn't support conditional requests may
+            # still send back exactly the same data.
+            digest = None
+            if c.status_code == 200:
+                digest = hashlib.blake2b(body, digest_size=16).digest()
+
+            if c.status_code == 304 or (digest is not None and self.digests.get(extra) == (request, digest)):
+                LOGGER.debug('%s not modified', extra)
+                if cached is not None:
+                    self.cache[extra] = (request, time.monotonic() + CACHE_TTL.get(extra, 0), cached[2])
+                return NOT_MODIFIED
+
+            jdata = json.loads(body)
+
+            # Aeris reports errors (bad location, exceeded limits, etc.)
+            # in the payload, don't hang on to those.
+            if c.status_code == 200 and isinstance(jdata, dict) and \
+                    jdata.get('success') and jdata.get('response'):
+                self.validators[extra] = (request, self._validators(c))
+                self.digests[extra] = (request, digest)
+                self.cache[extra] = (request, time.monotonic() + CACHE_TTL.get(extra, 0), jdata)
             LOGGER.debug(jdata)
-        except:
-            LOGGER.error('HTTP request failed for api.aerisapi.com')
+        except (requests.exceptions.Timeout, Urllib3Timeout):
+            LOGGER.error('HTTP request to api.aerisapi.com timed out')
+            jdata = None
+        except requests.exceptions.RequestException as e:
+            # The exception text includes the request URL, and with it
+            # the client secret, so only log what kind of error it was.
+            if is_timeout(e):
+                LOGGER.error('HTTP request to api.aerisapi.com timed out')
+            else:
+                LOGGER.error('HTTP request failed for api.aerisapi.com: {}'.format(type(e).__name__))
+            jdata = None
+        except ValueError as e:
+            LOGGER.error('Invalid response from api.aerisapi.com: {}'.format(e))
+            jdata = None
+        except Exception as e:
+            LOGGER.error('HTTP request failed for api.aerisapi.com: {}'.format(type(e).__name__))
             jdata = None
 
         return jdata
 
+    # Update the controller node from an observation query response.
+    # The data has multiple units, wmap picks the fields for the units
+    # the user has selected.
+    def _update_observation(self, n, jdata, wmap, force):
+        #jdata['response']['ob']['tempC']
+        response = jdata.get('response')
+        if not isinstance(response, dict):
+            LOGGER.error('No response object in query response.')
+            return
+
+        ob = response.get('ob')
+        if ob is None:
+            LOGGER.error('No observation object in query response.')
+            return
+
+        loc = response.get('loc')
+        if loc is None:
+            LOGGER.error('No location data in response.')
+        elif loc.get('lat') is None:
+            LOGGER.error('No latitude data in response.')
+        else:
+            self.latitude = float(loc['lat'])
+
+        update_drivers(n, wmap, ob, 'tag', NOT_OBSERVED, force)
+
     def query_conditions(self, address, units, force):
         # Query for the current conditions. We can do this fairly
         # frequently, probably as often as once a minute.
@@ -283,56 +446,30 @@ class queries(object):
             return
 
         precipitation = 0
-        wmap = WeatherData(units)
+        wmap = weather_data(units)
         n = self.poly.getNode(address)
-        prec = 1  ## TODO: this may need to go in wmap too or can we pull this from editor?
 
+        if force:
+            self._forget('observations', 'observations/summary')
+
+        # The observation and precipitation summary queries are
+        # independent, so run them at the same time.
         try:
-            jdata = self._get_weather_data('observations')
+            observations = self.pool.submit(self._get_weather_data, 'observations')
+            summary = self.pool.submit(self._get_weather_data, 'observations/summary')
+        except RuntimeError:
+            # close() shut the pool down while this poll was starting
+            LOGGER.debug('Query pool is shut down, skipping update')
+            return
+
+        try:
+            jdata = observations.result()
             if jdata == None:
                 LOGGER.error('Current condition query returned no data')
-                return
-            '''
-            Data from query has multiple units. Which one we want to use depends
-            on what the user has selected.  Since we set the node to metric by
-            default, lets just use those for testing.
-            '''
-        
-            #jdata['response']['ob']['tempC']
-            if 'response' not in jdata:
-                LOGGER.error('No response object in query response.')
-                return
-
-            if 'ob' not in jdata['response']:
-                LOGGER.error('No observation object in query response.')
-                return
-
-            if 'loc' in jdata['response']:
-                if 'lat' in jdata['response']['loc']:
-                    self.latitude = float(jdata['response']['loc']['lat'])
-                else:
-                    LOGGER.error('No latitude data in response.')
+            elif jdata is NOT_MODIFIED:
+                LOGGER.debug('Observation has not changed, skipping update')
             else:
-                LOGGER.error('No location data in response.')
-
-            ob = jdata['response']['ob']
-
-            for drv in n.drivers:
-                if drv['driver'] == 'PRECIP':
-                    continue # this comes from a different query
-                if drv['driver'] == 'ST':
-                    continue # Skip this
-
-                try:
-                    v = wmap.parse(drv['driver'], ob)
-                    if v == None or v == "None":
-                        v = "0"
-                    if drv['driver'] == 'GV15' and wmap.isMetric:
-                        v = v * 10 # snow depth is in cm, convert to mm
-                    n.setDriver(drv['driver'], round(float(v), prec), True, force, wmap.uom(drv['driver']))
-                    LOGGER.debug('setDriver (%s, %f)' %(drv['driver'], float(v)))
-                except Exception as e:
-                    LOGGER.warning('Error updating {}: {}'.format(drv['driver'], e))
+                self._update_observation(n, jdata, wmap, force)
 
         except Exception as e:
             LOGGER.error('Current observation update failure: {}'.format(e))
@@ -342,38 +479,39 @@ class queries(object):
         """
         try:
             # Get precipitation summary
-            jdata = self._get_weather_data('observations/summary')
+            jdata = summary.result()
             if jdata == None:
                 LOGGER.error('Precipitation summary query returned no data')
                 return
-            if 'response' not in jdata:
+            if jdata is NOT_MODIFIED:
+                LOGGER.debug('Precipitation summary has not changed, skipping update')
+                return
+            response = jdata.get('response')
+            if not response:
                 LOGGER.error('No response object in query response.')
                 return
 
             #LOGGER.debug(jdata)
 
-            if type(jdata['response']) is list:
-                rd = jdata['response'][0]['periods'][0]['summary']
-            else:
-                rd = jdata['response']['periods'][0]['summary']
+            if type(response) is list:
+                response = response[0]
+            rd = response['periods'][0]['summary']
 
             if 'precip' in rd:
                 if 'precip_summary' in rd['precip']:
-                    LOGGER.debug('precipitation info: ' + str(rd['precip'][self.tag['precip_summary']]))
-                    v = wmap.parse('PRECIP', rd['precip']['precip_summary'])
-                    if v == None or v == "None":
-                        v = "0"
-                    n.setDriver('PRECIP', round(float(v), 2), True, force, wmap.uom('PRECIP'))
+                    LOGGER.debug('precipitation info: %s', rd['precip']['precip_summary'])
+                    v = to_number(wmap.parse('PRECIP', rd['precip']['precip_summary']))
+                    if v is not None:
+                        n.setDriver('PRECIP', round(v, 2), True, force, wmap.uom('PRECIP'))
                 else:
-                    LOGGER.debug('Setting precipitation to: ' + str(rd['precip']))
-                    v = wmap.parse('PRECIP', rd['precip'])
-                    if v == None or v == "None":
-                        v = "0"
-                    n.setDriver('PRECIP', round(float(v), 2), True, force, wmap.uom('PRECIP'))
+                    LOGGER.debug('Setting precipitation to: %s', rd['precip'])
+                    v = to_number(wmap.parse('PRECIP', rd['precip']))
+                    if v is not None:
+                        n.setDriver('PRECIP', round(v, 2), True, force, wmap.uom('PRECIP'))
             else:
                 n.setDriver('PRECIP', 0, True, force, wmap.uom('PRECIP'))
                 
-        except Exception as e:
+        except (KeyError, IndexError, TypeError, ValueError) as e:
             LOGGER.error('Precipitation summary update failure: {}'.format(e))
             #update('PRECIP', precipitation)
                 
@@ -384,50 +522,30 @@ class queries(object):
             LOGGER.info('Skipping connection because we aren\'t configured yet.')
             return
 
-        wmap = WeatherData(units)
-        prec = 1
+        wmap = weather_data(units)
+        if force:
+            self._forget('forecasts')
+
         try:
             jdata = self._get_weather_data('forecasts')
             if jdata == None:
                 LOGGER.error('Current condition query returned no data')
                 return
+            if jdata is NOT_MODIFIED:
+                LOGGER.debug('Forecast has not changed, skipping update')
+                return
 
             # Records are for each day, midnight to midnight
-            day = 0
-            if 'periods' in jdata['response'][0]:
-                LOGGER.debug('Processing periods: %d' % len(jdata['response'][0]['periods']))
-                for forecast in jdata['response'][0]['periods']:
-                    address = 'forecast_' + str(day)
-                    LOGGER.debug(' >>>>   period ' + forecast['dateTimeISO'] + '  ' + address)
-                    epoch = int(forecast['timestamp'])
-                    n = self.poly.getNode(address)
-                    for drv in n.drivers:
-                        if drv['driver'] == 'ETO':  # etO, calculated value
-                            continue
-
-                        if drv['driver'] == 'GV19':  # day of week
-                            dow = time.strftime("%w", time.gmtime(epoch))
-                            n.setDriver(drv['driver'], dow, True, force, wmap.uom(drv['driver']))
-                            continue
-
-                        try:
-                            v = wmap.fparse(drv['driver'], forecast)
-                            if v == None or v == "None":
-                                v = "0"
-                            if drv['driver'] == 'GV15' and wmap.isMetric:
-                                v = v * 10 # snow depth is in cm, convert to mm
-                            n.setDriver(drv['driver'], round(float(v), prec), True, force, wmap.uom(drv['driver']))
-                            LOGGER.debug('setDriver (%s, %f)' %(drv['driver'], float(v)))
-                        except Exception as e:
-                            LOGGER.warning('Error updating {}: {}'.format(drv['driver'], e))
-
-                    n.max_humidity = float(forecast['maxHumidity'])
-                    n.min_humidity = float(forecast['minHumidity'])
-                    n.set_ETo(epoch, self.latitude, force)
-                    #n.update_forecast(forecast, self.latitude, self.tag, force)
-                    day += 1
-                    if day >= int(self.days):
-                        return
+            periods = jdata['response'][0].get('periods', [])[:self.days]
+            latitude = self.latitude
+            LOGGER.debug('Processing periods: %d', len(periods))
+            for day, (forecast, n) in enumerate(zip(periods, self.forecast_nodes)):
+                LOGGER.debug(' >>>>   period %s  forecast_%d', forecast['dateTimeISO'], day)
+                if n is None:
+                    LOGGER.warning('No forecast node for day {}, skipping'.format(day))
+                    continue
+
+                n.update_forecast(forecast, wmap, latitude, force)
 
         except Exception as e:
             LOGGER.error('Forecast data failure: {}'.format(e))